@@ -1,84 +1,162 @@
-from flask import Flask, request, jsonify
+import os
+
+# Tesseract's OpenMP threading is inefficient and would collide with the OCR
+# thread pool; must be set before tesserocr is imported
+os.environ.setdefault("OMP_THREAD_LIMIT", "1")
+
+from flask import Flask, Response, request
 from flask_cors import CORS
-import pytesseract
-from pdf2image import convert_from_path
+from tesserocr import PyTessBaseAPI, PSM, OEM
+import fitz  # PyMuPDF
 from PIL import Image
-import re, os, time
+import cv2
+import numpy as np
+import time, io, shutil, hashlib, threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import re2
+import orjson
 import logging
 
 # Setup logging
-logging.basicConfig(level=logging.INFO)
+# Defaults to WARNING so the per-request debug chatter costs nothing in
+# production; set LOGLEVEL=INFO or DEBUG to trace a request
+logging.basicConfig(level=os.environ.get("LOGLEVEL", "WARNING").upper())
 logger = logging.getLogger(__name__)
 
-os.makedirs("uploads", exist_ok=True)
-
-# Explicitly set tesseract path
-pytesseract.pytesseract.tesseract_cmd = "/usr/bin/tesseract"
-
 app = Flask(__name__)
-CORS(app, resources={r"/*": {"origins": "*"}}, methods=["GET", "POST", "OPTIONS"])
+CORS(app, resources={r"/*": {"origins": "*"}}, methods=["GET", "POST", "OPTIONS"], expose_headers=["ETag"])
 
 # Set max content length (10MB)
 app.config['MAX_CONTENT_LENGTH'] = 10 * 1024 * 1024
 
 # ---------- OCR + Parsing Logic ----------
 
-def extract_text(pdf_path):
-    logger.info(f"Starting OCR for file: {pdf_path}")
+# Below this many characters the embedded text layer is treated as missing
+MIN_TEXT_LAYER_CHARS = 50
+
+# Very low DPI for speed (minimum readable quality), capped at a page width
+RENDER_DPI = 100
+MAX_PAGE_WIDTH = 1500
+
+# Pages are OCR'd in parallel on a small thread pool; tesserocr releases the
+# GIL while Tesseract runs. gunicorn_config.py sets OCR_THREADS so that
+# workers x threads matches the core count; standalone, one process gets up
+# to 4 cores. Threads are started on demand, so a 1-page PDF uses only one.
+OCR_THREADS = int(os.environ.get("OCR_THREADS", min(4, os.cpu_count() or 1)))
+
+# 30 second timeout per page (milliseconds)
+OCR_TIMEOUT_MS = 30 * 1000
+
+# Tesseract C API handles, one per OCR thread, kept alive so the LSTM model
+# stays loaded between pages and requests. The pool and handles are created
+# lazily per process: with gunicorn --preload the master imports this module
+# and forks, and neither may be shared across that fork.
+_tess_local = threading.local()
+_ocr_executor = None
+_ocr_executor_pid = None
+
+def get_tess_api():
+    api = getattr(_tess_local, "api", None)
+    if api is None or _tess_local.pid != os.getpid():
+        logger.info("Initializing Tesseract API for %s...", threading.current_thread().name)
+        # Equivalent of '--psm 6 --oem 1' (fast mode)
+        api = PyTessBaseAPI(psm=PSM.SINGLE_BLOCK, oem=OEM.LSTM_ONLY)
+        _tess_local.api = api
+        _tess_local.pid = os.getpid()
+    return api
+
+def get_ocr_executor():
+    global _ocr_executor, _ocr_executor_pid
+    if _ocr_executor is None or _ocr_executor_pid != os.getpid():
+        _ocr_executor = ThreadPoolExecutor(max_workers=OCR_THREADS, thread_name_prefix="ocr")
+        _ocr_executor_pid = os.getpid()
+    return _ocr_executor
+
+def warm_up_ocr():
+    # Load the LSTM model on one OCR thread before the first request so it
+    # doesn't pay for it. Only one handle per process is loaded up front to
+    # keep resident memory low; further pool threads load theirs on demand.
+    # Meant to run once per worker process, after the fork.
+    start_time = time.time()
+    blank = Image.new("L", (32, 32), 255)
+
+    def warm_up_thread():
+        api = get_tess_api()
+        api.SetImage(blank)
+        api.GetUTF8Text()
+
+    get_ocr_executor().submit(warm_up_thread).result()
+    logger.info("Warmed up OCR in %.2f seconds", time.time() - start_time)
+
+def render_page(page):
+    # Rasterize straight at the final size rather than rendering at
+    # RENDER_DPI and downscaling wide pages afterwards
+    scale = RENDER_DPI / 72.0
+    scale = min(scale, MAX_PAGE_WIDTH / page.rect.width)
+    # Grayscale is faster
+    pix = page.get_pixmap(matrix=fitz.Matrix(scale, scale), colorspace=fitz.csGRAY)
+    return Image.frombytes("L", (pix.width, pix.height), pix.samples)
+
+def binarize(img):
+    # Adaptive threshold to black text on white: less background noise for
+    # the LSTM to chew through and cleaner glyphs on uneven scans
+    bw = cv2.adaptiveThreshold(
+        np.asarray(img), 255,
+        cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY,
+        31,  # Neighbourhood block size (px)
+        15   # Constant subtracted from the local mean
+    )
+    return Image.fromarray(bw)
+
+def ocr_page(page_number, img):
+    page_start = time.time()
+    logger.debug("Processing page %d, size: %s", page_number, img.size)
+    
+    # render_page already produces grayscale ('L') bitmaps
+    img = binarize(img)
+    
+    # Run OCR in-process through this thread's persistent Tesseract API
+    logger.debug("Running OCR on page %d...", page_number)
+    api = get_tess_api()
+    api.SetImage(img)
+    if not api.Recognize(timeout=OCR_TIMEOUT_MS):
+        logger.error("OCR timeout on page %d", page_number)
+        raise Exception("OCR took too long. Try a simpler PDF.")
+    page_text = api.GetUTF8Text()
+    logger.debug("OCR successful, extracted %d characters", len(page_text))
+    
+    page_duration = time.time() - page_start
+    logger.debug("Page %d completed in %.2fs", page_number, page_duration)
+    return page_text
+
+def extract_text_from_bytes(pdf_bytes):
+    logger.debug("Starting OCR for PDF (%d bytes)", len(pdf_bytes))
     start_time = time.time()
 
     try:
-        # CRITICAL: Use very low DPI and limit to first page only
-        logger.info("Converting PDF to images with low DPI...")
-        images = convert_from_path(
-            pdf_path, 
-            dpi=100,  # Very low DPI for speed (minimum readable quality)
-            # first_page=1, 
-            # last_page=1,  # ONLY first page for testing
-            thread_count=1,
-            grayscale=True  # Grayscale is faster
-        )
-        logger.info(f"Converted PDF to {len(images)} image(s)")
-
-        text = ""
-        for i, img in enumerate(images):
-            page_start = time.time()
-            logger.info(f"Processing page {i + 1}, original size: {img.size}")
-            
-            # Aggressively resize if still too large
-            max_width = 1500
-            width, height = img.size
-            if width > max_width:
-                ratio = max_width / width
-                new_size = (max_width, int(height * ratio))
-                img = img.resize(new_size, Image.Resampling.LANCZOS)
-                logger.info(f"Resized to {new_size}")
-            
-            # Convert to grayscale if not already
-            if img.mode != 'L':
-                img = img.convert('L')
-                logger.info("Converted to grayscale")
-            
-            # Use fastest Tesseract config with timeout
-            logger.info(f"Running OCR on page {i + 1}...")
-            try:
-                page_text = pytesseract.image_to_string(
-                    img,
-                    config='--psm 6 --oem 1',  # Fast mode
-                    timeout=30  # 30 second timeout per page
-                )
-                text += page_text
-                logger.info(f"OCR successful, extracted {len(page_text)} characters")
-            except RuntimeError as timeout_error:
-                logger.error(f"OCR timeout on page {i + 1}: {timeout_error}")
-                raise Exception("OCR took too long. Try a simpler PDF.")
-            
-            page_duration = time.time() - page_start
-            logger.info(f"Page {i + 1} completed in {page_duration:.2f}s")
-            
+        doc = fitz.open(stream=pdf_bytes, filetype="pdf")
+        try:
+            # Born-digital PDFs carry a real text layer - use it and skip OCR
+            text = "\n".join(page.get_text("text") for page in doc)
+            if len(text.strip()) >= MIN_TEXT_LAYER_CHARS:
+                duration = time.time() - start_time
+                logger.debug("Used embedded text layer (%d characters) in %.2f seconds", len(text), duration)
+                return text
+
+            # CRITICAL: Use very low DPI, rasterized in-process (no Poppler subprocess)
+            logger.debug("No usable text layer, converting PDF to images with low DPI...")
+            images = [render_page(page) for page in doc]
+        finally:
+            doc.close()
+        logger.debug("Converted PDF to %d image(s)", len(images))
+
+        page_texts = get_ocr_executor().map(ocr_page, range(1, len(images) + 1), images)
+        text = "".join(page_texts)
+
         duration = time.time() - start_time
-        logger.info(f"Total OCR completed in {duration:.2f} seconds")
-        logger.info(f"Total extracted text length: {len(text)} characters")
+        logger.debug("Total OCR completed in %.2f seconds", duration)
+        logger.debug("Total extracted text length: %d characters", len(text))
 
         if not text.strip():
             logger.warning("OCR returned empty text")
@@ -86,118 +164,208 @@ def extract_text(pdf_path):
 
         return text
         
-    except pytesseract.TesseractError as e:
-        logger.error(f"Tesseract error: {e}", exc_info=True)
+    except RuntimeError as e:
+        logger.error("Tesseract error: %s", e, exc_info=True)
         raise Exception("OCR processing failed. The PDF may be an image or corrupted.")
     except Exception as e:
-        logger.error(f"OCR failed: {e}", exc_info=True)
+        logger.error("OCR failed: %s", e, exc_info=True)
         raise
 
+# More flexible patterns: label alternatives and the value that follows them
+FIELD_LABELS = {
+    "owner": r"Owner|Name",
+    "address": r"Address|Property",
+    "tax_year": r"Tax Year|Year",
+    "amount_due": r"Amount Due|Total Due|Balance",
+    "due_date": r"Due Date|Payment Due"
+}
+
+# RE2's \s and \d are ASCII-only; these match what stdlib re's Unicode \s
+# and \d did, so e.g. the non-breaking spaces common in PDF text layers
+# still separate a label from its value
+WS = r"[\s\p{Z}\v\x1c-\x1f\x{85}]"
+DIGIT = r"\p{Nd}"
+
+FIELD_VALUES = {
+    "owner": r"(.+?)(?:\n|$)",
+    "address": r"(.+?)(?:\n|$)",
+    "tax_year": rf"({DIGIT}{{4}})",
+    "amount_due": rf"\$?{WS}*([{DIGIT},]+\.?{DIGIT}*)",
+    "due_date": r"(.+?)(?:\n|$)"
+}
+
+# Compiled once at import instead of on every request. None of the patterns
+# need backtracking, so they run on RE2's linear-time engine; the (?i) inline
+# flag is used because RE2 takes options rather than re-style flags.
+FIELD_PATTERNS = {
+    key: re2.compile(rf"(?i)(?:{FIELD_LABELS[key]}):{WS}*{FIELD_VALUES[key]}")
+    for key in FIELD_LABELS
+}
+
+# All labels fused into one alternation so the text is scanned once; the
+# named group that matched tells which field the label belongs to
+LABEL_RE = re2.compile(
+    "(?i)" + "|".join(rf"(?P<{key}>(?:{label}):)" for key, label in FIELD_LABELS.items())
+)
+
+# Address masking table: every ASCII digit becomes X in one C-level pass
+MASK_TABLE = str.maketrans("0123456789", "X" * 10)
+
+# str.translate is fastest for ASCII at any length, but on non-ASCII text it
+# falls off its fast path; past this length a NumPy pass over bytes wins
+NUMPY_MASK_MIN_LENGTH = 64
+
+def mask_digits(value):
+    if value.isascii() or len(value) <= NUMPY_MASK_MIN_LENGTH:
+        return value.translate(MASK_TABLE)
+    # Multi-byte UTF-8 sequences never contain bytes below 0x80, so masking
+    # 0x30-0x39 in the encoded bytes touches exactly the ASCII digits
+    arr = np.frombuffer(value.encode("utf-8", "replace"), dtype=np.uint8).copy()
+    arr[(arr >= 0x30) & (arr <= 0x39)] = ord("X")
+    return arr.tobytes().decode("utf-8", "replace")
+
 def parse_fields(text):
-    logger.info("Parsing extracted text for fields")
-    logger.info(f"Text preview (first 200 chars): {text[:200]}")
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Parsing extracted text for fields")
+        logger.debug("Text preview (first 200 chars): %s", text[:200])
     
-    data = {}
+    data = dict.fromkeys(FIELD_PATTERNS)
+    remaining = set(FIELD_PATTERNS)
     
-    # More flexible patterns
-    patterns = {
-        "owner": r"(?:Owner|Name):\s*(.+?)(?:\n|$)",
-        "address": r"(?:Address|Property):\s*(.+?)(?:\n|$)",
-        "tax_year": r"(?:Tax Year|Year):\s*(\d{4})",
-        "amount_due": r"(?:Amount Due|Total Due|Balance):\s*\$?\s*([\d,]+\.?\d*)",
-        "due_date": r"(?:Due Date|Payment Due):\s*(.+?)(?:\n|$)"
-    }
-    
-    for key, pattern in patterns.items():
-        match = re.search(pattern, text, re.IGNORECASE)
+    # Single pass over the labels; the value is only matched where its label
+    # starts, so each field still gets its first valid occurrence. Stops as
+    # soon as every field has been found.
+    for label in LABEL_RE.finditer(text):
+        key = label.lastgroup
+        if key not in remaining:
+            continue
+        match = FIELD_PATTERNS[key].match(text, label.start())
         if match:
-            value = match.group(1).strip()
-            data[key] = value
-            logger.info(f"Found {key}: {value}")
-        else:
-            data[key] = None
-            logger.warning(f"Could not find {key}")
+            data[key] = match.group(1).strip()
+            logger.debug("Found %s: %s", key, data[key])
+            remaining.discard(key)
+            if not remaining:
+                break
+    
+    for key in remaining:
+        logger.debug("Could not find %s", key)
     
-    logger.info(f"Extracted fields: {data}")
+    logger.debug("Extracted fields: %s", data)
     return data
 
+# ---------- Result Cache ----------
+
+# Parsed fields keyed by SHA-256 of the uploaded PDF; retries of the same
+# bill skip OCR entirely. Per-process, least recently used entries evicted.
+RESULT_CACHE_SIZE = 256
+_result_cache = OrderedDict()
+_result_cache_lock = threading.Lock()
+
+def get_cached_fields(digest):
+    with _result_cache_lock:
+        fields = _result_cache.get(digest)
+        if fields is not None:
+            _result_cache.move_to_end(digest)
+        return fields
+
+def cache_fields(digest, fields):
+    with _result_cache_lock:
+        _result_cache[digest] = fields
+        _result_cache.move_to_end(digest)
+        if len(_result_cache) > RESULT_CACHE_SIZE:
+            _result_cache.popitem(last=False)
+
 # ---------- Flask Routes ----------
 
+def json_response(obj, status=200):
+    # orjson serializes in C, skipping jsonify's stdlib json + key sorting
+    return Response(orjson.dumps(obj), status=status, mimetype="application/json")
+
 @app.route("/upload", methods=["OPTIONS"])
 def preflight_check():
-    logger.info("Preflight OPTIONS received")
-    return jsonify({"message": "CORS preflight OK"}), 200
+    logger.debug("Preflight OPTIONS received")
+    return json_response({"message": "CORS preflight OK"}, 200)
 
 @app.route("/upload", methods=["POST"])
 def upload_pdf():
-    logger.info("=" * 60)
-    logger.info("NEW UPLOAD REQUEST RECEIVED")
-    logger.info("=" * 60)
+    logger.debug("NEW UPLOAD REQUEST RECEIVED")
     start_time = time.time()
-    file_path = None
 
     try:
+        # Reject oversize bodies up front, before the multipart body is parsed
+        max_length = app.config['MAX_CONTENT_LENGTH']
+        if request.content_length is not None and request.content_length > max_length:
+            return json_response({"error": f"File too large (max {max_length // (1024 * 1024)}MB)"}, 413)
+
         if "file" not in request.files:
-            logger.error("No file part in the request")
-            return jsonify({"error": "No file uploaded"}), 400
+            logger.warning("No file part in the request")
+            return json_response({"error": "No file uploaded"}, 400)
 
         file = request.files["file"]
         
         if not file.filename:
-            return jsonify({"error": "No file selected"}), 400
+            return json_response({"error": "No file selected"}, 400)
             
         if not file.filename.lower().endswith('.pdf'):
-            return jsonify({"error": "Only PDF files allowed"}), 400
+            return json_response({"error": "Only PDF files allowed"}, 400)
 
-        # Generate unique filename
-        timestamp = int(time.time())
-        file_path = os.path.join("uploads", f"{timestamp}_{file.filename}")
+        # Check the magic bytes before reading the rest of the upload
+        if file.stream.read(5) != b"%PDF-":
+            return json_response({"error": "Only PDF files allowed"}, 400)
+        file.stream.seek(0)
 
-        # Save uploaded file
-        logger.info(f"Saving file: {file.filename} ({file.content_length} bytes)")
-        file.save(file_path)
-        file_size = os.path.getsize(file_path)
-        logger.info(f"File saved to: {file_path} (actual size: {file_size} bytes)")
+        # Read upload into memory in 64 KB chunks (no disk hop)
+        buf = io.BytesIO()
+        shutil.copyfileobj(file.stream, buf, length=64 * 1024)
+        pdf_bytes = buf.getvalue()
+        logger.debug("Read file: %s (%d bytes)", file.filename, len(pdf_bytes))
+
+        # The content hash doubles as the ETag; a client that already has
+        # the result for this exact file gets an empty 304
+        digest = hashlib.sha256(pdf_bytes).hexdigest()
+        # is_strong, not `in`: the latter also matches "If-None-Match: *"
+        if request.if_none_match.is_strong(digest):
+            logger.debug("ETag match for %s, returning 304", digest)
+            response = Response(status=304)
+            response.set_etag(digest)
+            return response
+
+        # Same bill already processed - return the cached result
+        cached = get_cached_fields(digest)
+        if cached is not None:
+            logger.debug("Cache hit for %s, skipping OCR", digest)
+            response = json_response(cached, 200)
+            response.set_etag(digest)
+            return response
 
         # Run OCR and extract fields
-        logger.info("Starting OCR extraction...")
-        text = extract_text(file_path)
+        logger.debug("Starting OCR extraction...")
+        text = extract_text_from_bytes(pdf_bytes)
         
         if not text.strip():
             logger.error("OCR returned empty text")
-            return jsonify({"error": "Could not extract text from PDF. The file may be corrupted or contain only images."}), 400
+            return json_response({"error": "Could not extract text from PDF. The file may be corrupted or contain only images."}, 400)
             
-        logger.info("OCR successful, parsing fields...")
+        logger.debug("OCR successful, parsing fields...")
         fields = parse_fields(text)
 
         # Mask numbers in address (compliance)
         if fields.get("address"):
-            original_address = fields["address"]
-            fields["address"] = re.sub(r"\d", "X", fields["address"])
-            logger.info(f"Masked address: {original_address} -> {fields['address']}")
+            fields["address"] = mask_digits(fields["address"])
+            logger.debug("Masked address: %s", fields["address"])
 
         duration = time.time() - start_time
-        logger.info("=" * 60)
-        logger.info(f"SUCCESS! Processing completed in {duration:.2f} seconds")
-        logger.info(f"Final extracted fields: {fields}")
-        logger.info("=" * 60)
+        logger.info("Processing completed in %.2f seconds", duration)
+        logger.debug("Final extracted fields: %s", fields)
         
-        return jsonify(fields), 200
+        cache_fields(digest, fields)
+        response = json_response(fields, 200)
+        response.set_etag(digest)
+        return response
 
     except Exception as e:
-        logger.error("=" * 60)
-        logger.error(f"ERROR: {str(e)}", exc_info=True)
-        logger.error("=" * 60)
-        return jsonify({"error": str(e)}), 500
-        
-    finally:
-        # Cleanup uploaded file
-        if file_path and os.path.exists(file_path):
-            try:
-                os.remove(file_path)
-                logger.info(f"Cleaned up file: {file_path}")
-            except Exception as e:
-                logger.error(f"Failed to cleanup file: {e}")
+        logger.error("ERROR: %s", e, exc_info=True)
+        return json_response({"error": str(e)}, 500)
 
 @app.route("/")
 def home():
@@ -205,18 +373,18 @@ def home():
 
 @app.route("/health")
 def health():
-    return {"status": "healthy", "timestamp": time.time()}, 200
+    return json_response({"status": "healthy", "timestamp": time.time()}, 200)
 
 @app.route("/test-ocr", methods=["POST"])
 def test_ocr():
     """Quick test without actual OCR"""
-    logger.info("Received /test-ocr request")
+    logger.debug("Received /test-ocr request")
     
     if "file" not in request.files:
-        return jsonify({"error": "No file uploaded"}), 400
+        return json_response({"error": "No file uploaded"}, 400)
     
     file = request.files["file"]
-    logger.info(f"File received: {file.filename}")
+    logger.debug("File received: %s", file.filename)
     
     mock_data = {
         "owner": "John Doe",
@@ -226,10 +394,16 @@ def test_ocr():
         "due_date": "2024-12-31"
     }
     
-    return jsonify(mock_data), 200
+    return json_response(mock_data, 200)
 
 # ---------- App Runner ----------
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 10000))
     debug = os.environ.get("FLASK_ENV") == "development"
+    # With the debug reloader only the child process serves requests
+    if not debug or os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        try:
+            warm_up_ocr()
+        except Exception as e:
+            logger.warning("OCR warm-up failed: %s", e)
     app.run(host="0.0.0.0", port=port, debug=debug)
\ No newline at end of file
@@ -1,6 +1,10 @@
 #!/usr/bin/env bash
 # Install system packages
-apt-get update && apt-get install -y tesseract-ocr poppler-utils
+apt-get update && apt-get install -y tesseract-ocr
+
+# The tesserocr wheel bundles libtesseract; at runtime it needs
+# TESSDATA_PREFIX=/usr/share/tesseract-ocr/5/tessdata to find language data
+export TESSDATA_PREFIX=/usr/share/tesseract-ocr/5/tessdata
 
 # Install Python dependencies
 pip install -r requirements.txt
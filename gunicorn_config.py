@@ -1,10 +1,33 @@
 import os
 
+# Tesseract's OpenMP threading is inefficient on small pages; run several
+# single-threaded workers instead. Must be set before the app is loaded.
+os.environ.setdefault("OMP_THREAD_LIMIT", "1")
+
 bind = f"0.0.0.0:{os.environ.get('PORT', 10000)}"
-workers = 1  # Single worker to avoid memory issues on free tier
-worker_class = "sync"
+# One single-threaded OCR worker per core. os.cpu_count() sees the host, not
+# the container's CPU quota, so deployments can cap it with WEB_CONCURRENCY.
+workers = int(os.environ.get("WEB_CONCURRENCY", max(2, os.cpu_count() or 2)))
+
+# Split the cores between workers so workers x OCR threads doesn't
+# oversubscribe them (one OCR thread per worker by default)
+os.environ.setdefault("OCR_THREADS", str(max(1, (os.cpu_count() or 1) // workers)))
+worker_class = "gthread"
+threads = 1
+preload_app = True  # Load the app once in the master, share it copy-on-write
 timeout = 120  # 2 minute timeout
 keepalive = 5
 accesslog = "-"
 errorlog = "-"
-loglevel = "info"
\ No newline at end of file
+loglevel = os.environ.get("LOGLEVEL", "warning").lower()
+capture_output = True  # Route app stdout/stderr through gunicorn's error log
+
+def post_worker_init(worker):
+    # Tesseract handles are per process, so warm one up in each worker
+    # after the fork rather than in the preloading master
+    from app import warm_up_ocr
+    try:
+        warm_up_ocr()
+    except Exception as e:
+        # Not fatal: the first request will initialize (and report) instead
+        worker.log.warning("OCR warm-up failed: %s", e)
\ No newline at end of file